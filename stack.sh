@@ -475,6 +475,18 @@ if [[ -n "$LOGFILE" ]]; then
     LOGFILE=$LOGFILE.${CURRENT_LOG_TIME}
     SUMFILE=$LOGFILE.summary.${CURRENT_LOG_TIME}
 
+    _of_log_args="-B"
+    _of_log_suffix=""
+    if [[ -n "$LOGFILE_COMPRESS" ]]; then
+        case "$LOGFILE_COMPRESS" in
+            gzip) _of_log_suffix=".gz" ;;
+            zstd) _of_log_suffix=".zst" ;;
+            *) die $LINENO "LOGFILE_COMPRESS must be gzip or zstd" ;;
+        esac
+        _of_log_args+=" -z $LOGFILE_COMPRESS --index"
+        LOGFILE=$LOGFILE$_of_log_suffix
+    fi
+
     # Redirect output according to config
 
     # Set fd 3 to a copy of stdout. So we can set fd 1 without losing
@@ -486,19 +498,19 @@ if [[ -n "$LOGFILE" ]]; then
             _of_args="$_of_args --no-timestamp"
         fi
         # Set fd 1 and 2 to write the log file
-        exec 1> >( $PYTHON $TOP_DIR/tools/outfilter.py $_of_args -o "${LOGFILE}" ) 2>&1
+        exec 1> >( $PYTHON $TOP_DIR/tools/outfilter.py $_of_args $_of_log_args -o "${LOGFILE}" ) 2>&1
         # Set fd 6 to summary log file
-        exec 6> >( $PYTHON $TOP_DIR/tools/outfilter.py -o "${SUMFILE}" )
+        exec 6> >( $PYTHON $TOP_DIR/tools/outfilter.py -B -o "${SUMFILE}" )
     else
         # Set fd 1 and 2 to primary logfile
-        exec 1> >( $PYTHON $TOP_DIR/tools/outfilter.py -o "${LOGFILE}" ) 2>&1
+        exec 1> >( $PYTHON $TOP_DIR/tools/outfilter.py $_of_log_args -o "${LOGFILE}" ) 2>&1
         # Set fd 6 to summary logfile and stdout
-        exec 6> >( $PYTHON $TOP_DIR/tools/outfilter.py -v -o "${SUMFILE}" >&3 )
+        exec 6> >( $PYTHON $TOP_DIR/tools/outfilter.py -v -B -o "${SUMFILE}" >&3 )
     fi
 
     echo_summary "stack.sh log $LOGFILE"
     # Specified logfile name always links to the most recent log
-    ln -sf $LOGFILE $LOGFILE_DIR/$LOGFILE_NAME
+    ln -sf $LOGFILE $LOGFILE_DIR/$LOGFILE_NAME$_of_log_suffix
     ln -sf $SUMFILE $LOGFILE_DIR/$LOGFILE_NAME.summary
 else
     # Set up output redirection without log files
@@ -546,9 +558,11 @@ function exit_trap {
             generate-subunit $DEVSTACK_START_TIME $SECONDS 'fail' >> ${SUBUNIT_OUTPUT}
         fi
         if [[ -z $LOGDIR ]]; then
-            ${PYTHON} $TOP_DIR/tools/worlddump.py
+            ${PYTHON} $TOP_DIR/tools/worlddump.py \
+                --instances-dir "$NOVA_INSTANCES_PATH"
         else
-            ${PYTHON} $TOP_DIR/tools/worlddump.py -d $LOGDIR
+            ${PYTHON} $TOP_DIR/tools/worlddump.py -d $LOGDIR \
+                --instances-dir "$NOVA_INSTANCES_PATH"
         fi
     else
         # If we error before we've installed os-testr, this will fail.
@@ -884,12 +898,6 @@ if is_service_enabled tls-proxy; then
     init_cert
 fi
 
-# Dstat
-# -----
-
-# Install dstat services prerequisites
-install_dstat
-
 
 # Check Out and Install Source
 # ----------------------------
@@ -1511,9 +1519,15 @@ merge_config_group $TOP_DIR/local.conf test-config
 set +o xtrace
 
 if [[ -n "$LOGFILE" ]]; then
-    exec 1>&3
-    # Force all output to stdout and logs now
-    exec 1> >( tee -a "${LOGFILE}" ) 2>&1
+    # Keep writing through the log's outfilter rather than appending to
+    # the log behind its back: it may still hold buffered output, and a
+    # compressed log would be corrupted. When verbose, that goes to
+    # stdout already.
+    if [[ "$VERBOSE" != "True" ]]; then
+        exec 7>&1
+        # Force all output to stdout and logs now
+        exec 1> >( tee /dev/fd/7 >&3 ) 2>&1
+    fi
 else
     # Force all output to stdout now
     exec 1>&3
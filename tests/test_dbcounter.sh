@@ -0,0 +1,65 @@
+#!/bin/bash
+
+# Round trip through the SQLite sink of the dbcounter plugin: count some
+# statements, write them out and add them up again with get-stats.py
+
+TOP=$(cd $(dirname "$0")/.. && pwd)
+
+source $TOP/tests/unittest.sh
+
+PYTHON=${PYTHON:-python3}
+
+if ! ${PYTHON} -c 'import sqlalchemy' 2>/dev/null; then
+    echo "sqlalchemy not installed, skipping dbcounter tests"
+    report_results
+fi
+
+OUT_DIR=$(mktemp -d)
+
+cat > $OUT_DIR/round_trip.py <<'EOF'
+import importlib.util
+import sys
+
+import sqlalchemy
+
+import dbcounter
+
+top, out_dir = sys.argv[1:]
+url = sqlalchemy.engine.make_url(
+    'sqlite:///%s/test.db?dbcounter_sink=sqlite&dbcounter_path=%s' % (
+        out_dir, out_dir))
+plugin = dbcounter.LogCursorEventsPlugin(url, {})
+engine = sqlalchemy.create_engine(plugin.update_url(url))
+plugin.engine_created(engine)
+with engine.begin() as conn:
+    conn.execute(sqlalchemy.text('CREATE TABLE t (a INTEGER)'))
+    for i in range(3):
+        conn.execute(sqlalchemy.text('INSERT INTO t VALUES (%i)' % i))
+    conn.execute(sqlalchemy.text('SELECT a FROM t')).fetchall()
+plugin.flush()
+
+spec = importlib.util.spec_from_file_location(
+    'get_stats', '%s/tools/get-stats.py' % top)
+get_stats = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(get_stats)
+args = get_stats.argparse.Namespace(
+    db_type='mysql', db_pass=None,
+    db_file=['%s/dbcounter-*.sqlite' % out_dir])
+dbs = get_stats.connect_stats_dbs(args)
+print(' '.join('%(op)s=%(count)i' % row
+               for row in get_stats.get_db_stats(dbs)))
+EOF
+
+RESULT=$(PYTHONPATH=$TOP/tools/dbcounter${PYTHONPATH:+:$PYTHONPATH} \
+    ${PYTHON} $OUT_DIR/round_trip.py $TOP $OUT_DIR)
+
+if [[ $? -ne 0 ]]; then
+    failed "dbcounter round trip failed"
+else
+    assert_equal "CREATE=1 INSERT=3 SELECT=1" "$RESULT" \
+        "counts read back from the SQLite sink"
+fi
+
+rm -rf $OUT_DIR
+
+report_results
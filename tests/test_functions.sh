@@ -290,4 +290,44 @@ function test_export_proxy_variables {
 }
 test_export_proxy_variables
 
+function test_openstack_batch {
+    echo "Testing openstack_batch()"
+
+    local results
+
+    # Stand in for the client; fails on "fail"
+    function openstack {
+        echo "[$*]"
+        [[ "$1" != "fail" ]]
+    }
+
+    results=$(openstack_batch <<EOF
+--os-region-name=RegionOne flavor create --id 1 "m1 tiny"
+
+# a comment
+flavor list
+EOF
+)
+    if [[ $? -eq 0 && "$results" == $'[--os-region-name=RegionOne flavor create --id 1 m1 tiny]\n[flavor list]' ]]; then
+        passed "OK: commands are run in order with shell quoting"
+    else
+        failed "Unexpected output: $results"
+    fi
+
+    results=$(openstack_batch <<EOF
+flavor list
+fail 3
+flavor show 1
+EOF
+)
+    if [[ $? -ne 0 && "$results" == $'[flavor list]\n[fail 3]' ]]; then
+        passed "OK: the batch stops at the first failure"
+    else
+        failed "Unexpected output: $results"
+    fi
+
+    unset -f openstack
+}
+test_openstack_batch
+
 report_results
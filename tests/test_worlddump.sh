@@ -32,4 +32,41 @@ fi
 
 rm -rf $OUT_DIR
 
+# The JSON format has a record for every collector, in order, and one
+# for every command it ran
+OUT_DIR=$(mktemp -d)
+
+${PYTHON} $TOP/tools/worlddump.py -f json -d $OUT_DIR
+
+if [[ $? -ne 0 ]]; then
+    failed "worlddump -f json failed"
+else
+    cat > $OUT_DIR/check.py <<'EOF'
+import json
+import sys
+
+import worlddump
+
+with open(sys.argv[1]) as f:
+    doc = json.load(f)
+names = [c['collector'] for c in doc['collectors']]
+if names != [c.__name__ for c in worlddump.COLLECTORS]:
+    sys.exit('unexpected collectors %s' % names)
+for collector in doc['collectors']:
+    for command in collector['commands']:
+        missing = {'command', 'rc', 'duration'} - set(command)
+        if missing:
+            sys.exit('%s lacks %s' % (collector['collector'], missing))
+EOF
+    ERROR=$(PYTHONPATH=$TOP/tools ${PYTHON:-python3} $OUT_DIR/check.py \
+        $OUT_DIR/worlddump-latest.json 2>&1)
+    if [[ $? -ne 0 ]]; then
+        failed "worlddump JSON output: $ERROR"
+    else
+        passed "worlddump JSON output has a record per collector"
+    fi
+fi
+
+rm -rf $OUT_DIR
+
 report_results
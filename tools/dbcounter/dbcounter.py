@@ -1,9 +1,15 @@
+import argparse
+import atexit
+import functools
+import hashlib
 import json
 import logging
 import os
+import re
+import tempfile
 import threading
 import time
-import queue
+import weakref
 
 import sqlalchemy
 from sqlalchemy.engine import CreateEnginePlugin
@@ -19,29 +25,310 @@ LOG = logging.getLogger(__name__)
 # being in the database connection URL, which gives us an opportunity
 # to hook the engines that get created.
 #
-# We opportunistically spawn a thread, which we feed "hits" to over a
-# queue, and which occasionally writes those hits to a special
-# database called 'stats'. We access that database with the same user,
-# pass, and host as the main connection URL for simplicity.
+# Every thread counts its "hits" in a dict of its own, which no other
+# thread ever modifies, so counting takes no locks. We opportunistically
+# spawn a thread, which periodically collects the new hits from those
+# dicts, and which occasionally writes them to a sink. By default that
+# is a special database called 'stats', which we access with the same
+# user, pass, and host as the main connection URL for simplicity. With
+# dbcounter_sink=sqlite in the URL, every process writes to a SQLite
+# file of its own instead (in dbcounter_path, or the temp directory),
+# which get-stats.py merges, so no database server is needed at all.
+#
+# Under eventlet, threading.local is per greenthread, so there the dicts
+# are per greenthread too: every RPC or API request handled in its own
+# greenthread registers one, and the writer drops it once the
+# greenthread is gone and its last hits are collected.
+#
+# Besides counting every statement by operation, we time them and count
+# the rows they return, per table, into a histogram with fixed buckets
+# so that memory use does not depend on the number of statements.
+# Statements are also normalized into fingerprints, with their literals
+# and bind parameters replaced, and counted and timed per fingerprint to
+# find the hottest queries of each service. Only the first
+# MAX_FINGERPRINTS fingerprints a process sees are counted on their own,
+# the statements of any later ones all count as OTHER_FINGERPRINT, so
+# that neither the counters nor the table grow without bounds.
+
+# Counter kind: (table in the stats database, key columns, value column)
+STATS_TABLES = {
+    'queries': ('queries', ('db', 'op'), 'count'),
+    'latency': ('query_latency', ('db', 'op', 'tbl', 'bucket'), 'count'),
+    'rows': ('query_rows', ('db', 'op', 'tbl'), 'returned'),
+    'fingerprints': ('query_fingerprints',
+                     ('db', 'fp_hash', 'fingerprint'), 'count'),
+    'fingerprint_time': ('query_fingerprints',
+                         ('db', 'fp_hash', 'fingerprint'), 'time_us'),
+}
+
+# Table in the stats database: (column definitions, primary key). The
+# MySQL and PostgreSQL tables are created by lib/databases from the
+# output of this module when run as a script, and the SQLite ones by
+# the sink when it first writes.
+STATS_SCHEMA = {
+    'queries': ('db VARCHAR(32), op VARCHAR(32), count INTEGER',
+                ('db', 'op')),
+    'query_latency': ('db VARCHAR(32), op VARCHAR(32), tbl VARCHAR(64), '
+                      'bucket INTEGER, count INTEGER',
+                      ('db', 'op', 'tbl', 'bucket')),
+    'query_rows': ('db VARCHAR(32), op VARCHAR(32), tbl VARCHAR(64), '
+                   'returned BIGINT',
+                   ('db', 'op', 'tbl')),
+    'query_fingerprints': ('db VARCHAR(32), fp_hash CHAR(40), '
+                           'fingerprint VARCHAR(1024), '
+                           'count INTEGER DEFAULT 0, '
+                           'time_us BIGINT DEFAULT 0',
+                           ('db', 'fp_hash')),
+}
+# The MySQL tables kept in memory. query_fingerprints stays on InnoDB,
+# as MEMORY tables store a VARCHAR at its full width.
+MYSQL_MEMORY_TABLES = ('queries', 'query_latency', 'query_rows')
+
+# Rows per INSERT, to stay below the packet size and bind parameter
+# limits of the servers and of SQLite
+MAX_ROWS = 200
+
+# Latency buckets are powers of two of milliseconds, each counting the
+# statements which took less than that; the last one counts the rest.
+MAX_BUCKET = 1 << 16
+
+TABLE_REGEX = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+`?(\w+)', re.IGNORECASE)
+
+# Applied in order to turn a statement into its fingerprint
+FINGERPRINT_SUBS = (
+    # String literals
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+    # Bind parameters, in any of the paramstyles of the DB-API drivers
+    (re.compile(r'%\(\w+\)s|%s|:\w+|\?'), '?'),
+    # Numbers not part of an identifier
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    # IN-lists and VALUES of any length, and any number of VALUES rows
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?+)'),
+    (re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+'), '(?+)'),
+    (re.compile(r'\s+'), ' '),
+)
+MAX_FINGERPRINT = 1024
+# get-stats.py reports the top 20 by default; a service normally issues a
+# few hundred distinct statements in all, so this leaves plenty of room.
+MAX_FINGERPRINTS = 1000
+OTHER_FINGERPRINT = '(other statements)'
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_info(statement):
+    """Return the operation and first table of an SQL statement.
+
+    The operation is the first word of the statement, or 'OTHER' if it
+    cannot be determined. SQLAlchemy issues the same statement strings
+    over and over, so this is cached.
+    """
+    try:
+        op = statement.strip().split(' ', 1)[0] or 'OTHER'
+    except Exception:
+        op = 'OTHER'
+    match = TABLE_REGEX.search(statement)
+    return op, match.group(1) if match else ''
+
+
+@functools.lru_cache(maxsize=4096)
+def fingerprint(statement):
+    """Return the hash and fingerprint of an SQL statement.
+
+    Statements which only differ in their literals, bind parameters or
+    the length of their IN-lists get the same fingerprint.
+    """
+    for regex, replacement in FINGERPRINT_SUBS:
+        statement = regex.sub(replacement, statement)
+    statement = statement.strip()[:MAX_FINGERPRINT]
+    return hashlib.sha1(statement.encode('utf-8')).hexdigest(), statement
+
+
+def schema_statements(if_not_exists=False, mysql=False):
+    """Return the CREATE TABLE statements of the stats tables."""
+    return ['CREATE TABLE %s%s (%s, PRIMARY KEY (%s))%s' % (
+        'IF NOT EXISTS ' if if_not_exists else '', table, definition,
+        ', '.join(key),
+        ' ENGINE MEMORY' if mysql and table in MYSQL_MEMORY_TABLES else '')
+        for table, (definition, key) in sorted(STATS_SCHEMA.items())]
+
+
+def latency_bucket(elapsed):
+    """Return the histogram bucket for a statement taking elapsed secs."""
+    return min(1 << int(elapsed * 1000).bit_length(), MAX_BUCKET)
+
+
+class StatsSink(object):
+    """Where the writer thread puts the counters.
+
+    A sink owns an engine, created on first use, and turns the rows of
+    each kind of counter into statements which add to what the table
+    holds already.
+    """
+    def __init__(self, url, db_name):
+        self.url = sqlalchemy.engine.URL.create(url.drivername,
+                                                url.username,
+                                                url.password,
+                                                url.host,
+                                                url.port,
+                                                'stats')
+        self.engine = None
+
+    def create_engine(self):
+        # Only the writer thread uses this engine, one flush at a time,
+        # so keep it to a single connection.
+        return sqlalchemy.create_engine(self.url,
+                                        pool_size=1,
+                                        max_overflow=0,
+                                        pool_pre_ping=True)
+
+    def create_tables(self, conn):
+        pass
+
+    def upsert(self, table, columns, value, rows):
+        raise NotImplementedError()
+
+    def write(self, writes):
+        """Add rows of (columns..., count) to their tables.
+
+        All of writes, a list of (table, columns, value column, rows),
+        goes in a single transaction.
+        """
+        if self.engine is None:
+            self.engine = self.create_engine()
+            with self.engine.begin() as conn:
+                self.create_tables(conn)
+        with self.engine.begin() as conn:
+            for table, columns, value, rows in writes:
+                for start in range(0, len(rows), MAX_ROWS):
+                    batch = rows[start:start + MAX_ROWS]
+                    names = [['%s%i' % (column, i)
+                              for column in columns + (value,)]
+                             for i in range(len(batch))]
+                    params = {}
+                    for row_names, row in zip(names, batch):
+                        params.update(zip(row_names, row))
+                    conn.execute(sqlalchemy.text(self.upsert(
+                        table, columns, value,
+                        ', '.join('(%s)' % ', '.join(':' + n for n in row)
+                                  for row in names))), params)
+
+    def after_fork(self):
+        # Leave the parent's connections to the parent
+        if self.engine is not None:
+            self.engine.dispose(close=False)
+
+
+class MySQLSink(StatsSink):
+    """The stats database on the MySQL server we measure."""
+    def upsert(self, table, columns, value, rows):
+        return ('INSERT INTO %s (%s) VALUES %s '
+                'ON DUPLICATE KEY UPDATE %s=%s+VALUES(%s)' % (
+                    table, ', '.join(columns + (value,)), rows,
+                    value, value, value))
+
+
+class PostgreSQLSink(MySQLSink):
+    """The stats database on the PostgreSQL server we measure."""
+    def upsert(self, table, columns, value, rows):
+        return ('INSERT INTO %s (%s) VALUES %s '
+                'ON CONFLICT (%s) DO UPDATE SET %s=%s.%s+EXCLUDED.%s' % (
+                    table, ', '.join(columns + (value,)), rows,
+                    ', '.join(STATS_SCHEMA[table][1]),
+                    value, table, value, value))
+
+
+class SQLiteSink(PostgreSQLSink):
+    """A SQLite file per process, in WAL mode.
+
+    Each process writes to a file of its own, so writers never wait for
+    each other across processes; get-stats.py adds them all up.
+    """
+    def __init__(self, url, db_name):
+        self.directory = url.query.get('dbcounter_path',
+                                       tempfile.gettempdir())
+        # Measuring SQLite itself, the database name is a path
+        self.db_name = os.path.basename(db_name or 'memory')
+        super().__init__(url, db_name)
+
+    def create_engine(self):
+        # A forked child gets a file of its own on its first write
+        path = os.path.join(self.directory, 'dbcounter-%s-%i.sqlite' % (
+            self.db_name, os.getpid()))
+        engine = sqlalchemy.create_engine('sqlite:///%s' % path,
+                                          connect_args={'timeout': 30})
+
+        @event.listens_for(engine, 'connect')
+        def set_wal(dbapi_conn, record):
+            dbapi_conn.execute('PRAGMA journal_mode=WAL')
+
+        return engine
+
+    def create_tables(self, conn):
+        for statement in schema_statements(if_not_exists=True):
+            conn.execute(sqlalchemy.text(statement))
+
+    def after_fork(self):
+        super().after_fork()
+        self.engine = None
+
+
+SINKS = {
+    'mysql': MySQLSink,
+    'postgresql': PostgreSQLSink,
+    'sqlite': SQLiteSink,
+}
+
+
+class ThreadCounts(object):
+    """The hit counters of one thread, keyed by (kind, db, op, ...).
+
+    Counters only ever go up. The writer thread keeps a copy of what it
+    has already accounted for and writes out the difference.
+    """
+    def __init__(self):
+        self.counts = {}
 
 
 class LogCursorEventsPlugin(CreateEnginePlugin):
     def __init__(self, url, kwargs):
         self.db_name = url.database
-        LOG.info('Registered counter for database %s' % self.db_name)
-        new_url = sqlalchemy.engine.URL.create(url.drivername,
-                                               url.username,
-                                               url.password,
-                                               url.host,
-                                               url.port,
-                                               'stats')
-
-        self.engine = sqlalchemy.create_engine(new_url)
-        self.queue = queue.Queue()
+        sink = url.query.get('dbcounter_sink', url.get_backend_name())
+        LOG.info('Registered counter for database %s, writing to %s' % (
+            self.db_name, sink))
+        self.sink = SINKS[sink](url, self.db_name)
+        # Fingerprint hashes counted on their own. Kept across forks, as
+        # the counters of a child only add to those of its parent.
+        self.fingerprints = set()
+        self.other_fingerprint = (
+            hashlib.sha1(OTHER_FINGERPRINT.encode('utf-8')).hexdigest(),
+            OTHER_FINGERPRINT)
+        self._reset()
+
+        # A forked child (e.g. a uwsgi or oslo.service worker) starts
+        # counting from scratch: whatever the parent counted before the
+        # fork is the parent's to write. Short-lived processes write
+        # out what they counted on exit rather than losing up to a
+        # minute of hits.
+        os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self.local = threading.local()
+        # (weakref to a thread's ThreadCounts, its counts, accounted for)
+        self.threads = []
+        self.threads_lock = threading.Lock()
+        # Collected but not yet written, guarded by flush_lock
+        self.pending = {}
+        self.flush_lock = threading.Lock()
         self.thread = None
 
+    def _after_fork(self):
+        self._reset()
+        self.sink.after_fork()
+
     def update_url(self, url):
-        return url.difference_update_query(["dbcounter"])
+        return url.difference_update_query(
+            [key for key in url.query if key.startswith('dbcounter')])
 
     def engine_created(self, engine):
         """Hook the engine creation process.
@@ -51,14 +338,28 @@ class LogCursorEventsPlugin(CreateEnginePlugin):
         the engine is created, giving us a chance to hook it below.
         """
         event.listen(engine, "before_cursor_execute", self._log_event)
+        event.listen(engine, "after_cursor_execute", self._log_time)
 
     def ensure_writer_thread(self):
         self.thread = threading.Thread(target=self.stat_writer, daemon=True)
         self.thread.start()
 
+    def _thread_counts(self):
+        """Create and register the counters of the current thread."""
+        counters = self.local.counters = ThreadCounts()
+        with self.threads_lock:
+            self.threads.append((weakref.ref(counters), counters.counts, {}))
+        return counters.counts
+
+    def _counts(self):
+        try:
+            return self.local.counters.counts
+        except AttributeError:
+            return self._thread_counts()
+
     def _log_event(self, conn, cursor, statement, parameters, context,
                    executemany):
-        """Queue a "hit" for this operation to be recorded.
+        """Count a "hit" for this operation.
 
         Attepts to determine the operation by the first word of the
         statement, or 'OTHER' if it cannot be determined.
@@ -66,56 +367,143 @@ class LogCursorEventsPlugin(CreateEnginePlugin):
 
         # Start our thread if not running. If we were forked after the
         # engine was created and this plugin was associated, our
-        # writer thread is gone, so respawn.
-        if not self.thread or not self.thread.is_alive():
+        # writer thread is gone and _after_fork() cleared it, so respawn.
+        if self.thread is None:
             self.ensure_writer_thread()
 
+        op, table = statement_info(statement)
+
+        counts = self._counts()
+        key = ('queries', self.db_name, op)
+        counts[key] = counts.get(key, 0) + 1
+
+        # Statements on a connection run one at a time, and one that
+        # fails never gets to _log_time(), so a single slot is enough.
+        conn.info['dbcounter_start'] = time.time()
+
+    def _log_time(self, conn, cursor, statement, parameters, context,
+                  executemany):
+        """Account the time taken and rows returned by a statement."""
         try:
-            op = statement.strip().split(' ', 1)[0] or 'OTHER'
-        except Exception:
-            op = 'OTHER'
+            elapsed = time.time() - conn.info.pop('dbcounter_start')
+        except KeyError:
+            return
+        op, table = statement_info(statement)
+
+        counts = self._counts()
+        key = ('latency', self.db_name, op, table, latency_bucket(elapsed))
+        counts[key] = counts.get(key, 0) + 1
+        if cursor.rowcount > 0:
+            key = ('rows', self.db_name, op, table)
+            counts[key] = counts.get(key, 0) + cursor.rowcount
+
+        fp_hash, fp = fingerprint(statement)
+        if fp_hash not in self.fingerprints:
+            # Several threads may get past this at once, which can only
+            # overshoot the limit by a few.
+            if len(self.fingerprints) < MAX_FINGERPRINTS:
+                self.fingerprints.add(fp_hash)
+            else:
+                fp_hash, fp = self.other_fingerprint
+        key = ('fingerprints', self.db_name, fp_hash, fp)
+        counts[key] = counts.get(key, 0) + 1
+        key = ('fingerprint_time', self.db_name, fp_hash, fp)
+        counts[key] = counts.get(key, 0) + int(elapsed * 1000000)
 
-        self.queue.put((self.db_name, op))
+    def collect(self, to_write):
+        """Add the hits counted since the last call to to_write.
 
-    def do_incr(self, db, op, count):
-        """Increment the counter for (db,op) by count."""
+        Returns the number of new hits.
+        """
+        new = 0
+        finished_ids = set()
+        with self.threads_lock:
+            threads = list(self.threads)
+        for entry in threads:
+            ref, counts, seen = entry
+            # Check this first: once the thread is gone its counts can
+            # not change any more, so the snapshot below is the last.
+            finished = ref() is None
+            # Copying a dict is atomic, even while its thread updates it
+            snapshot = dict(counts)
+            for key, count in snapshot.items():
+                delta = count - seen.get(key, 0)
+                if delta:
+                    to_write[key] = to_write.get(key, 0) + delta
+                    new += delta
+            seen.update(snapshot)
+            if finished:
+                finished_ids.add(id(entry))
+        if finished_ids:
+            # In one pass, as there can be thousands of them under
+            # eventlet. Threads may have registered in the meantime.
+            with self.threads_lock:
+                self.threads = [entry for entry in self.threads
+                                if id(entry) not in finished_ids]
+        return new
+
+    def do_incr(self, to_write):
+        """Increment the counter for each key in to_write by count.
+
+        The counters of each kind go in multi-row INSERTs into their
+        table, all in a single transaction.
+        """
 
-        query = sqlalchemy.text('INSERT INTO queries (db, op, count) '
-                                '  VALUES (:db, :op, :count) '
-                                '  ON DUPLICATE KEY UPDATE count=count+:count')
+        writes = []
+        # Sorted, so concurrent writers lock the rows in the same order
+        for kind, (table, columns, value) in sorted(STATS_TABLES.items()):
+            rows = sorted(key[1:] + (count,)
+                          for key, count in to_write.items()
+                          if key[0] == kind)
+            if rows:
+                writes.append((table, columns, value, rows))
         try:
-            with self.engine.begin() as conn:
-                r = conn.execute(query, {'db': db, 'op': op, 'count': count})
+            self.sink.write(writes)
         except Exception as e:
-            LOG.error('Failed to account for access to database %r: %s',
-                      db, e)
+            LOG.error('Failed to account for access to databases %s: %s',
+                      ','.join(sorted(set(key[1] for key in to_write))), e)
 
     def stat_writer(self):
-        """Consume messages from the queue and write them in batches.
+        """Collect the hits of all threads and write them in batches.
 
-        This reads "hists" from from a queue fed by _log_event() and
-        writes (db,op)+=count stats to the database after ten seconds
-        of no activity to avoid triggering a write for every SELECT
-        call. Write no less often than every sixty seconds to avoid being
-        starved by constant activity.
+        This collects the "hits" counted by _log_event() and
+        _log_time() every ten seconds and writes (kind,db,op,...)+=count
+        stats to the database once ten seconds pass with no activity, to
+        avoid triggering a write for every SELECT call. Write no less
+        often than every sixty seconds to avoid being starved by
+        constant activity.
         """
         LOG.debug('[%i] Writer thread running' % os.getpid())
         while True:
-            to_write = {}
             last = time.time()
             while time.time() - last < 60:
-                try:
-                    item = self.queue.get(timeout=10)
-                    to_write.setdefault(item, 0)
-                    to_write[item] += 1
-                except queue.Empty:
-                    break
+                time.sleep(10)
+                with self.flush_lock:
+                    if not self.collect(self.pending):
+                        break
+
+            self.flush()
+
+    def flush(self):
+        """Write out everything counted so far."""
+        with self.flush_lock:
+            self.collect(self.pending)
+            to_write, self.pending = self.pending, {}
 
             if to_write:
                 LOG.debug('[%i] Writing DB stats %s' % (
                     os.getpid(),
-                    ','.join(['%s:%s=%i' % (db, op, count)
-                              for (db, op), count in to_write.items()])))
+                    ','.join(['%s=%i' % (':'.join(map(str, key)), count)
+                              for key, count in to_write.items()])))
+                self.do_incr(to_write)
+
 
-            for (db, op), count in to_write.items():
-                self.do_incr(db, op, count)
+if __name__ == '__main__':
+    # The schema, for lib/databases to create the tables with
+    parser = argparse.ArgumentParser(
+        description='Print the DDL of the dbcounter stats tables')
+    parser.add_argument('--mysql', action='store_true',
+                        help='Use MEMORY tables where MySQL can')
+    args = parser.parse_args()
+    for statement in schema_statements(mysql=args.mysql):
+        print(statement + ';')
@@ -1,24 +1,22 @@
 #!/usr/bin/python3
 
 import argparse
-import csv
+import collections
+import concurrent.futures
 import datetime
 import glob
+import gzip
 import itertools
 import json
 import logging
+import math
 import os
 import re
 import socket
+import sqlite3
 import subprocess
 import sys
-
-try:
-    import psutil
-except ImportError:
-    psutil = None
-    print('No psutil, process information will not be included',
-          file=sys.stderr)
+import time
 
 try:
     import pymysql
@@ -27,6 +25,11 @@ except ImportError:
     print('No pymysql, database information will not be included',
           file=sys.stderr)
 
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
 LOG = logging.getLogger('perf')
 
 # https://www.elastic.co/blog/found-crash-elasticsearch#mapping-explosion
@@ -39,144 +42,599 @@ def tryint(value):
         return value
 
 
-def get_service_stats(service):
-    stats = {'MemoryCurrent': 0}
-    output = subprocess.check_output(['/usr/bin/systemctl', 'show', service] +
-                                     ['-p%s' % stat for stat in stats])
-    for line in output.decode().split('\n'):
-        if not line:
+# Where systemd puts the cgroups of services on cgroup v2 hosts
+CGROUP_ROOT = '/sys/fs/cgroup/system.slice'
+CPU_STAT_REGEX = re.compile(r'^usage_usec (\d+)$', re.MULTILINE)
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def get_services():
+    return [os.path.basename(s) for s in
+            glob.glob('/etc/systemd/system/devstack@*.service')] + \
+            ['apache2.service']
+
+
+def get_service_cgroups(services):
+    """Return the cgroup directory of each running service.
+
+    All of them are found in one walk of the system slice and of the
+    slices in it, like system-devstack.slice for the devstack@ units.
+    """
+    wanted = set(services)
+    cgroups = {}
+    slices = [CGROUP_ROOT]
+    while slices:
+        try:
+            entries = list(os.scandir(slices.pop()))
+        except FileNotFoundError:
             continue
-        stat, val = line.split('=')
-        stats[stat] = tryint(val)
+        for entry in entries:
+            if entry.name in wanted:
+                cgroups[entry.name] = entry.path
+            elif entry.name.endswith('.slice') and entry.is_dir():
+                slices.append(entry.path)
+    return cgroups
+
 
+def get_cgroup_stats(cgroup):
+    """Return the memory and CPU usage of a cgroup, like systemd does."""
+    stats = {}
+    try:
+        with open(os.path.join(cgroup, 'memory.current')) as f:
+            stats['MemoryCurrent'] = int(f.read())
+        with open(os.path.join(cgroup, 'cpu.stat')) as f:
+            match = CPU_STAT_REGEX.search(f.read())
+        if match:
+            stats['CPUUsageNSec'] = int(match.group(1)) * 1000
+    except FileNotFoundError:
+        # The service just stopped
+        pass
+    return stats
+
+
+def get_systemctl_stats(services):
+    """Ask systemd for the stats of all services, in one call."""
+    output = subprocess.check_output(
+        ['/usr/bin/systemctl', 'show', '-pMemoryCurrent', '-pCPUUsageNSec'] +
+        services)
+    stats = []
+    # One block of properties per service, in order
+    for block in output.decode().split('\n\n'):
+        stats.append(dict((stat, tryint(val)) for stat, val in
+                          (line.split('=', 1) for line in block.split('\n')
+                           if line)))
     return stats
 
 
 def get_services_stats():
-    services = [os.path.basename(s) for s in
-                glob.glob('/etc/systemd/system/devstack@*.service')] + \
-                ['apache2.service']
-    return [dict(service=service, **get_service_stats(service))
-            for service in services]
+    services = get_services()
+    if os.path.isdir(CGROUP_ROOT):
+        cgroups = get_service_cgroups(services)
+        stats = [get_cgroup_stats(cgroups[service])
+                 if service in cgroups else {}
+                 for service in services]
+    else:
+        stats = get_systemctl_stats(services)
+    return [dict({'MemoryCurrent': 0}, service=service, **service_stats)
+            for service, service_stats in zip(services, stats)]
 
 
-def get_process_stats(proc):
-    cmdline = proc.cmdline()
-    if 'python' in cmdline[0]:
-        cmdline = cmdline[1:]
-    return {'cmd': cmdline[0],
-            'pid': proc.pid,
-            'args': ' '.join(cmdline[1:]),
-            'rss': proc.memory_info().rss}
+# What each sample records per service, from all of its processes: CPU
+# seconds, RSS, bytes read and written, open file descriptors
+SAMPLE_FIELDS = ('cpu', 'rss', 'io_read', 'io_write', 'fds')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
 
 
-def get_processes_stats(matches):
-    me = os.getpid()
-    procs = psutil.process_iter()
+def get_cgroup_pids(cgroup):
+    try:
+        with open(os.path.join(cgroup, 'cgroup.procs')) as f:
+            return [int(pid) for pid in f.read().split()]
+    except FileNotFoundError:
+        return []
 
-    def proc_matches(proc):
-        return me != proc.pid and any(
-            re.search(match, ' '.join(proc.cmdline()))
-            for match in matches)
 
-    return [
-        get_process_stats(proc)
-        for proc in procs
-        if proc_matches(proc)]
+def get_pid_sample(pid):
+    """Return the SAMPLE_FIELDS of a process, or None if it is gone."""
+    try:
+        with open('/proc/%i/stat' % pid) as f:
+            # The command may contain spaces, the fields after it don't
+            stat = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/%i/statm' % pid) as f:
+            rss = int(f.read().split()[1]) * PAGE_SIZE
+        io = {}
+        try:
+            with open('/proc/%i/io' % pid) as f:
+                for line in f:
+                    key, value = line.split(':')
+                    io[key] = int(value)
+        except PermissionError:
+            pass
+        try:
+            fds = len(os.listdir('/proc/%i/fd' % pid))
+        except PermissionError:
+            fds = 0
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    return [(int(stat[11]) + int(stat[12])) / CLOCK_TICKS, rss,
+            io.get('read_bytes', 0), io.get('write_bytes', 0), fds]
+
+
+def get_services_sample():
+    sample = {}
+    for service, cgroup in get_service_cgroups(get_services()).items():
+        pids = get_cgroup_pids(cgroup)
+        if not pids:
+            continue
+        totals = [0] * len(SAMPLE_FIELDS)
+        for pid in pids:
+            values = get_pid_sample(pid)
+            if values is not None:
+                totals = [a + b for a, b in zip(totals, values)]
+        # The cgroup still counts the CPU time of processes which exited
+        cpu = get_cgroup_stats(cgroup).get('CPUUsageNSec')
+        if cpu is not None:
+            totals[0] = cpu / 1e9
+        totals[0] = round(totals[0], 2)
+        sample[service] = totals
+    return sample
+
+
+def sample_services(sample_file, interval):
+    """Sample the services every interval seconds until killed.
+
+    The samples are appended to sample_file as NDJSON: a header naming
+    the fields, then one line per sample with the values of each
+    service in that order.
+    """
+    with open(sample_file, 'a', buffering=1) as f:
+        f.write(json.dumps({'fields': SAMPLE_FIELDS,
+                            'interval': interval,
+                            'hostname': socket.gethostname()}) + '\n')
+        while True:
+            start = time.time()
+            f.write(json.dumps({'time': round(start, 1),
+                                'services': get_services_sample()},
+                               separators=(',', ':')) + '\n')
+            time.sleep(max(0, interval - (time.time() - start)))
+
+
+def summarize_samples(sample_file):
+    """Summarize the samples of each service over the whole run.
+
+    Peaks are reported for RSS and file descriptors. CPU and IO are
+    totals of the increases between samples, so processes which come
+    and go are still accounted for. The RSS integral, in MiB * seconds,
+    is the memory a service held over time.
+    """
+    services = {}
+    with open(sample_file) as f:
+        for line in f:
+            try:
+                sample = json.loads(line)
+            except ValueError:
+                # Cut short by the sampler being killed
+                continue
+            if 'fields' in sample:
+                fields = sample['fields']
+                continue
+            for service, values in sample['services'].items():
+                values = dict(zip(fields, values))
+                summary = services.get(service)
+                if summary is None:
+                    services[service] = {
+                        'first': sample['time'], 'last': sample['time'],
+                        'previous': values, 'samples': 1,
+                        'cpu': 0, 'io_read': 0, 'io_write': 0,
+                        'peak_rss': values['rss'], 'peak_fds': values['fds'],
+                        'rss_integral': 0}
+                    continue
+                previous = summary['previous']
+                for field in ('cpu', 'io_read', 'io_write'):
+                    summary[field] += max(0, values[field] - previous[field])
+                summary['rss_integral'] += ((values['rss'] + previous['rss'])
+                                            / 2 * (sample['time'] -
+                                                   summary['last']))
+                summary['peak_rss'] = max(summary['peak_rss'], values['rss'])
+                summary['peak_fds'] = max(summary['peak_fds'], values['fds'])
+                summary['last'] = sample['time']
+                summary['previous'] = values
+                summary['samples'] += 1
+
+    return [{'service': service,
+             'samples': summary['samples'],
+             'duration': round(summary['last'] - summary['first'], 1),
+             'cpu': round(summary['cpu'], 2),
+             'io_read': summary['io_read'],
+             'io_write': summary['io_write'],
+             'peak_rss': summary['peak_rss'],
+             'peak_fds': summary['peak_fds'],
+             'rss_integral': round(summary['rss_integral'] / (1 << 20), 1)}
+            for service, summary in sorted(services.items())]
+
+
+def read_cmdline(pid):
+    """Return the command line of a process as a list, like psutil."""
+    with open('/proc/%i/cmdline' % pid, 'rb') as f:
+        cmdline = f.read().decode('utf-8', 'replace').rstrip('\0')
+    args = cmdline.split('\0')
+    if len(args) == 1 and ' ' in cmdline:
+        # Processes which set their title separate their args with spaces
+        args = cmdline.split(' ')
+    return args
 
 
-def get_db_stats(host, user, passwd):
-    dbs = []
+def get_processes_stats(matches):
+    """Get the processes with a command line matching any of matches.
+
+    This is a single pass over /proc, with a single regex made of all
+    of matches.
+    """
+    me = os.getpid()
+    match = re.compile('|'.join('(?:%s)' % m for m in matches)).search
+    stats = []
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit() or int(entry.name) == me:
+            continue
+        pid = int(entry.name)
+        try:
+            cmdline = read_cmdline(pid)
+            if not cmdline[0] or not match(' '.join(cmdline)):
+                continue
+            with open('/proc/%i/statm' % pid) as f:
+                rss = int(f.read().split()[1]) * PAGE_SIZE
+        except (FileNotFoundError, ProcessLookupError):
+            # Gone already
+            continue
+        if 'python' in cmdline[0] and len(cmdline) > 1:
+            cmdline = cmdline[1:]
+        stats.append({'cmd': cmdline[0],
+                      'pid': pid,
+                      'args': ' '.join(cmdline[1:]),
+                      'rss': rss})
+    return stats
+
+
+def connect_stats_db(host, user, passwd, db_type='mysql'):
+    if db_type == 'postgresql':
+        driver, kwargs = psycopg2, {'dbname': 'stats'}
+    else:
+        driver, kwargs = pymysql, {'database': 'stats'}
     try:
-        db = pymysql.connect(host=host, user=user, password=passwd,
-                             database='stats',
-                             cursorclass=pymysql.cursors.DictCursor)
-    except pymysql.err.OperationalError as e:
-        if 'Unknown database' in str(e):
+        return driver.connect(host=host, user=user, password=passwd,
+                              **kwargs)
+    except driver.OperationalError as e:
+        if 'Unknown database' in str(e) or 'does not exist' in str(e):
             print('No stats database; assuming devstack failed',
                   file=sys.stderr)
-            return []
+            return None
         raise
 
-    with db:
-        with db.cursor() as cur:
-            cur.execute('SELECT db,op,count FROM queries')
-            for row in cur:
-                dbs.append({k: tryint(v) for k, v in row.items()})
+
+def connect_stats_dbs(args):
+    """Connect to every stats database dbcounter may have written to.
+
+    That is the stats database on the database server, if we can reach
+    it, and the SQLite files of each process using the sqlite sink.
+    """
+    dbs = []
+    driver = psycopg2 if args.db_type == 'postgresql' else pymysql
+    if driver and args.db_pass:
+        db = connect_stats_db(args.db_host, args.db_user, args.db_pass,
+                              args.db_type)
+        if db is not None:
+            dbs.append(db)
+    for pattern in args.db_file:
+        dbs.extend(sqlite3.connect(path)
+                   for path in sorted(glob.glob(pattern)))
     return dbs
 
 
+def query_stats_dbs(dbs, query):
+    """Run query on all stats databases and yield each row as a dict.
+
+    With the sqlite sink, each process has counted into a database of
+    its own, so the same key can show up in several of them; callers
+    add the rows up.
+    """
+    for db in dbs:
+        cur = db.cursor()
+        try:
+            cur.execute(query)
+            columns = [column[0] for column in cur.description]
+            for row in cur:
+                yield dict(zip(columns, row))
+        finally:
+            cur.close()
+
+
+def get_db_stats(dbs):
+    queries = collections.Counter()
+    for row in query_stats_dbs(dbs, 'SELECT db,op,count FROM queries'):
+        queries[(row['db'], row['op'])] += int(row['count'])
+    return [{'db': db, 'op': op, 'count': count}
+            for (db, op), count in sorted(queries.items())]
+
+
+def histogram_percentile(buckets, percentile):
+    """Return the bucket a percentile falls in from {bucket: count}."""
+    total = sum(buckets.values())
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen * 100 >= total * percentile:
+            return bucket
+    return 0
+
+
+def get_db_table_stats(dbs):
+    """Get per-table statement latency and row counts from dbcounter.
+
+    Latencies come from histograms with power-of-two millisecond
+    buckets, so each percentile is reported as the upper bound of the
+    bucket it falls in.
+    """
+    tables = {}
+    for row in query_stats_dbs(
+            dbs, 'SELECT db,op,tbl,bucket,count FROM query_latency'):
+        buckets = tables.setdefault((row['db'], row['op'], row['tbl']),
+                                    collections.Counter())
+        buckets[int(row['bucket'])] += int(row['count'])
+    rows = collections.Counter()
+    for row in query_stats_dbs(
+            dbs, 'SELECT db,op,tbl,returned FROM query_rows'):
+        rows[(row['db'], row['op'], row['tbl'])] += int(row['returned'])
+
+    return [{'db': db, 'op': op, 'table': table,
+             'count': sum(buckets.values()),
+             'rows': rows[(db, op, table)],
+             'p50': histogram_percentile(buckets, 50),
+             'p90': histogram_percentile(buckets, 90),
+             'p99': histogram_percentile(buckets, 99)}
+            for (db, op, table), buckets in sorted(tables.items())]
+
+
+def get_db_query_stats(dbs, top):
+    """Get the most frequent query fingerprints of each database."""
+    fingerprints = {}
+    for row in query_stats_dbs(
+            dbs, 'SELECT db,fp_hash,fingerprint,count,time_us '
+                 'FROM query_fingerprints'):
+        stats = fingerprints.setdefault(
+            (row['db'], row['fp_hash']),
+            {'query': row['fingerprint'], 'count': 0, 'time_us': 0})
+        stats['count'] += int(row['count'])
+        stats['time_us'] += int(row['time_us'])
+
+    queries = []
+    for db_name, rows in itertools.groupby(
+            sorted(fingerprints.items(),
+                   key=lambda item: (item[0][0], -item[1]['count'])),
+            lambda item: item[0][0]):
+        for _, stats in itertools.islice(rows, top):
+            queries.append({
+                'db': db_name,
+                'query': stats['query'],
+                'count': stats['count'],
+                'time': stats['time_us'] // 1000,
+                'avg': stats['time_us'] / max(stats['count'], 1) / 1000,
+            })
+    return queries
+
+
+# The fields of a combined access log we look at. The service is the
+# first component of the URL. The time taken to serve the request may
+# follow the User-Agent, as lib/apache configures it: %D, in
+# microseconds, or %T with a unit suffix like "(ms)".
+APACHE_LOG_REGEX = re.compile(
+    rb'\S+ \S+ \S+ \[[^\]]*\] '
+    rb'"(?P<method>[^ "]*) /*(?P<service>[^/ "]*)[^ "]* (?P<http>[^ "]*)" '
+    rb'\S+ (?P<length>\S+) '
+    rb'"[^"\\]*(?:\\.[^"\\]*)*" '
+    rb'"(?P<agent>[^"\\]*(?:\\.[^"\\]*)*)"'
+    rb'(?: (?P<time>\d+)(?:\((?P<unit>us|ms|s)\))?)?')
+IGNORE_AGENTS = ('curl', 'uwsgi', 'nova-status')
+
+# Request times are counted in buckets growing by LATENCY_GAMMA, so a
+# percentile read from them is within LATENCY_ACCURACY of the real
+# value, in a bounded number of buckets however long the log is.
+LATENCY_ACCURACY = 0.01
+LATENCY_GAMMA = (1 + LATENCY_ACCURACY) / (1 - LATENCY_ACCURACY)
+LATENCY_LOG_GAMMA = math.log(LATENCY_GAMMA)
+LATENCY_UNITS = {None: 1, b'us': 1, b'ms': 1000, b's': 1000000}
+
+
+def open_log(logfile):
+    """Open a log for reading in binary, gzipped or not."""
+    with open(logfile, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return gzip.open(logfile, 'rb')
+    return open(logfile, 'rb', buffering=1 << 20)
+
+
+def get_agent(agent):
+    """Return the short name of a User-Agent."""
+    # Tempest's User-Agent is unchanged, but client libraries and
+    # inter-service API calls use proper strings. So assume
+    # 'python-urllib' is tempest so we can tell it apart.
+    if b'python-urllib' in agent.lower():
+        return 'tempest'
+    agent = agent.split(b' ')[0].decode('utf-8', 'replace')
+    if agent.startswith('python-'):
+        agent = agent.replace('python-', '')
+    if '/' in agent:
+        agent = agent.split('/')[0]
+    return agent
+
+
+def latency_value(bucket):
+    """Return the latency in milliseconds a bucket stands for."""
+    return 2 * LATENCY_GAMMA ** bucket / (LATENCY_GAMMA + 1) / 1000
+
+
 def get_http_stats_for_log(logfile):
+    # Lines are only counted per (method, service, User-Agent) in the
+    # loop, as [count, largest, latency buckets]; everything else is
+    # done once per key afterwards.
+    entries = {}
+    match_line = APACHE_LOG_REGEX.match
+    log_, ceil = math.log, math.ceil
+    with open_log(logfile) as log:
+        for line in log:
+            match = match_line(line)
+            if match is None:
+                # Not a combined access log, so we can bail completely
+                return [], []
+            method, service, http, length, agent, usecs, unit = \
+                match.groups()
+            if b'HTTP' not in http:
+                # Not a combined access log, so we can bail completely
+                return [], []
+
+            key = (method, service, agent)
+            try:
+                length = int(length)
+            except ValueError:
+                LOG.warning('[%s] Failed to parse length %r from line %r' % (
+                    logfile, length, line))
+                length = 0
+            entry = entries.get(key)
+            if entry is None:
+                entry = entries[key] = [0, 0, {}]
+            entry[0] += 1
+            if length > entry[1]:
+                entry[1] = length
+            if usecs is not None:
+                # The bucket is the log of the microseconds, in base
+                # LATENCY_GAMMA
+                bucket = ceil(log_(int(usecs) * LATENCY_UNITS[unit] or 1) /
+                              LATENCY_LOG_GAMMA)
+                buckets = entry[2]
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+
     stats = {}
-    apache_fields = ('host', 'a', 'b', 'date', 'tz', 'request', 'status',
-                     'length', 'c', 'agent')
-    ignore_agents = ('curl', 'uwsgi', 'nova-status')
+    service_latencies = {}
     ignored_services = set()
-    for line in csv.reader(open(logfile), delimiter=' '):
-        fields = dict(zip(apache_fields, line))
-        if len(fields) != len(apache_fields):
-            # Not a combined access log, so we can bail completely
-            return []
-        try:
-            method, url, http = fields['request'].split(' ')
-        except ValueError:
-            method = url = http = ''
-        if 'HTTP' not in http:
-            # Not a combined access log, so we can bail completely
-            return []
-
-        # Tempest's User-Agent is unchanged, but client libraries and
-        # inter-service API calls use proper strings. So assume
-        # 'python-urllib' is tempest so we can tell it apart.
-        if 'python-urllib' in fields['agent'].lower():
-            agent = 'tempest'
-        else:
-            agent = fields['agent'].split(' ')[0]
-            if agent.startswith('python-'):
-                agent = agent.replace('python-', '')
-            if '/' in agent:
-                agent = agent.split('/')[0]
-
-        if agent in ignore_agents:
+    for (method, service, agent), (count, largest, buckets) in \
+            entries.items():
+        agent = get_agent(agent)
+        if agent in IGNORE_AGENTS:
             continue
 
-        try:
-            service, rest = url.strip('/').split('/', 1)
-        except ValueError:
-            # Root calls like "GET /identity"
-            service = url.strip('/')
-            rest = ''
-
+        service = service.decode('utf-8', 'replace')
         if not service.isalpha():
             ignored_services.add(service)
             continue
 
-        method_key = '%s-%s' % (agent, method)
-        try:
-            length = int(fields['length'])
-        except ValueError:
-            LOG.warning('[%s] Failed to parse length %r from line %r' % (
-                logfile, fields['length'], line))
-            length = 0
-        stats.setdefault(service, {'largest': 0})
-        stats[service].setdefault(method_key, 0)
-        stats[service][method_key] += 1
-        stats[service]['largest'] = max(stats[service]['largest'],
-                                        length)
+        method_key = '%s-%s' % (agent, method.decode('utf-8', 'replace'))
+        service_stats = stats.setdefault(service, {'largest': 0})
+        service_stats.setdefault(method_key, 0)
+        service_stats[method_key] += count
+        service_stats['largest'] = max(service_stats['largest'], largest)
+        if buckets:
+            service_latencies.setdefault(
+                (service, method.decode('utf-8', 'replace')),
+                collections.Counter()).update(buckets)
 
     if ignored_services:
         LOG.warning('Ignored services: %s' % ','.join(
             sorted(ignored_services)))
 
     # Flatten this for ES
-    return [{'service': service, 'log': os.path.basename(logfile),
-             **vals}
-            for service, vals in stats.items()]
+    log = os.path.basename(logfile)
+    return ([{'service': service, 'log': log, **vals}
+             for service, vals in stats.items()],
+            [{'service': service, 'log': log, 'method': method,
+              'count': sum(buckets.values()),
+              'p50': round(latency_value(
+                  histogram_percentile(buckets, 50)), 2),
+              'p90': round(latency_value(
+                  histogram_percentile(buckets, 90)), 2),
+              'p99': round(latency_value(
+                  histogram_percentile(buckets, 99)), 2)}
+             for (service, method), buckets in sorted(
+                 service_latencies.items())])
 
 
 def get_http_stats(logfiles):
-    return list(itertools.chain.from_iterable(get_http_stats_for_log(log)
-                                              for log in logfiles))
+    """Parse the access logs in parallel, one process per log.
+
+    Returns the call counts and the latency percentiles, in ms, per
+    service and HTTP method of all logs.
+    """
+    if len(logfiles) < 2:
+        stats = list(map(get_http_stats_for_log, logfiles))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                min(len(logfiles), os.cpu_count() or 1)) as pool:
+            stats = list(pool.map(get_http_stats_for_log, logfiles))
+    return (list(itertools.chain.from_iterable(calls for calls, _ in stats)),
+            list(itertools.chain.from_iterable(times for _, times in stats)))
+
+
+def get_report_metrics(report):
+    """Return the comparable stats of a report.
+
+    The result maps (kind, name) to a value, where kind is 'memory' or
+    'count' and name identifies the entry and stat, aligned on service,
+    db/op or process command line rather than on list position or pid.
+    """
+    metrics = collections.Counter()
+
+    def add(kind, name, value):
+        if isinstance(value, (int, float)):
+            metrics[(kind, name)] += value
+
+    for service in report.get('services', []):
+        add('memory', 'service %s MemoryCurrent' % service['service'],
+            service.get('MemoryCurrent'))
+    for service in report.get('service_samples', []):
+        add('memory', 'service %s peak_rss' % service['service'],
+            service.get('peak_rss'))
+    for process in report.get('processes', []):
+        # Several processes can share a command line, like workers
+        add('memory', 'process %s %s rss' % (process['cmd'],
+                                             process['args']),
+            process.get('rss'))
+    for db in report.get('db', []):
+        add('count', 'db %s %s' % (db['db'], db['op']), db.get('count'))
+    for api in report.get('api', []):
+        for key, value in api.items():
+            if key not in ('service', 'log', 'largest'):
+                add('count', 'api %s %s' % (api['service'], key), value)
+    return metrics
+
+
+def compare_reports(baseline, current, threshold=10, min_memory=16,
+                    z_score=3):
+    """Return the stats of current which regressed from baseline.
+
+    A stat regresses if it grew by more than threshold percent and by
+    more than noise: memory by more than min_memory MiB, and counts,
+    which vary like a Poisson process, by more than z_score standard
+    deviations of the baseline count. Each regression is a dict with
+    the name, both values and the change in percent.
+    """
+    if (baseline.get('report', {}).get('version') !=
+            current.get('report', {}).get('version')):
+        LOG.warning('Comparing reports of different versions')
+    base_metrics = get_report_metrics(baseline)
+    regressions = []
+    for (kind, name), value in sorted(get_report_metrics(current).items()):
+        base = base_metrics.get((kind, name), 0)
+        increase = value - base
+        if kind == 'memory':
+            noise = min_memory * (1 << 20)
+        else:
+            noise = z_score * math.sqrt(max(base, 1))
+        if increase > base * threshold / 100 and increase > noise:
+            regressions.append({
+                'name': name,
+                'baseline': base,
+                'current': value,
+                'change': round(increase * 100 / base, 1) if base else None,
+            })
+    return regressions
 
 
 def get_report_info():
@@ -197,24 +655,85 @@ if __name__ == '__main__':
                         help='MySQL password for db-user')
     parser.add_argument('--db-host', default='localhost',
                         help='MySQL hostname')
+    parser.add_argument('--db-type', default='mysql',
+                        choices=('mysql', 'postgresql'),
+                        help=('Type of the database server with the stats '
+                              'database (default: "mysql")'))
+    parser.add_argument('--db-file', action='append', default=[],
+                        help=('Merge in the stats of dbcounter SQLite files '
+                              'matching this glob'))
+    parser.add_argument('--top-queries', type=int, default=10,
+                        help=('Number of hottest queries to report per '
+                              'database (default: 10)'))
     parser.add_argument('--apache-log', action='append', default=[],
                         help='Collect API call stats from this apache log')
     parser.add_argument('--process', action='append',
                         default=process_defaults,
                         help=('Include process stats for this cmdline regex '
                               '(default is %s)' % ','.join(process_defaults)))
+    parser.add_argument('--sample-interval', type=float, default=None,
+                        help=('Instead of reporting, sample the services '
+                              'every this many seconds into --sample-file '
+                              'until killed'))
+    parser.add_argument('--sample-file', default=None,
+                        help=('File of service samples, summarized in the '
+                              'report if it exists'))
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help=('Instead of reporting, compare two reports and '
+                              'exit non-zero if CURRENT regressed'))
+    parser.add_argument('--threshold', type=float, default=10,
+                        help=('Percent increase of a stat which counts as a '
+                              'regression (default: 10)'))
+    parser.add_argument('--min-memory', type=float, default=16,
+                        help=('Memory increase in MiB below which it is '
+                              'noise (default: 16)'))
+    parser.add_argument('--z-score', type=float, default=3,
+                        help=('Standard deviations a count must grow by to '
+                              'be significant (default: 3)'))
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.WARNING)
 
+    if args.compare:
+        reports = []
+        for report in args.compare:
+            with open(report) as f:
+                reports.append(json.load(f))
+        regressions = compare_reports(*reports,
+                                      threshold=args.threshold,
+                                      min_memory=args.min_memory,
+                                      z_score=args.z_score)
+        for regression in regressions:
+            if regression['change'] is None:
+                change = 'new'
+            else:
+                change = '%s%%' % regression['change']
+            print('REGRESSION %s: %s -> %s (%s)' % (
+                regression['name'], regression['baseline'],
+                regression['current'], change))
+        sys.exit(1 if regressions else 0)
+
+    if args.sample_interval:
+        if not args.sample_file:
+            parser.error('--sample-interval requires --sample-file')
+        sample_services(args.sample_file, args.sample_interval)
+
+    dbs = connect_stats_dbs(args)
+    api, api_latency = get_http_stats(args.apache_log)
     data = {
         'services': get_services_stats(),
-        'db': pymysql and args.db_pass and get_db_stats(args.db_host,
-                                                        args.db_user,
-                                                        args.db_pass) or [],
-        'processes': psutil and get_processes_stats(args.process) or [],
-        'api': get_http_stats(args.apache_log),
+        'db': get_db_stats(dbs),
+        'db_tables': get_db_table_stats(dbs),
+        'db_queries': get_db_query_stats(dbs, args.top_queries),
+        'processes': get_processes_stats(args.process),
+        'api': api,
+        'api_latency': api_latency,
+        'service_samples': (args.sample_file and
+                            os.path.exists(args.sample_file) and
+                            summarize_samples(args.sample_file) or []),
         'report': get_report_info(),
     }
+    for db in dbs:
+        db.close()
 
     print(json.dumps(data, indent=2))
@@ -24,6 +24,9 @@ fi
 # time to sleep between checks
 SLEEP_TIME=20
 
+# text or json, the output format of mlock_report.py
+MLOCK_REPORT_FORMAT=text
+
 # MemAvailable is the best estimation and has built-in heuristics
 # around reclaimable memory.  However, it is not available until 3.14
 # kernel (i.e. Ubuntu LTS Trusty misses it).  In that case, we fall
@@ -93,7 +96,7 @@ function tracker {
             # list processes that lock memory from swap
             if [[ $unevictable -ne $unevictable_point ]]; then
                 unevictable_point=$unevictable
-                ${PYTHON} $(dirname $0)/mlock_report.py
+                ${PYTHON} $(dirname $0)/mlock_report.py --format $MLOCK_REPORT_FORMAT
             fi
 
             echo "]]]"
@@ -103,12 +106,15 @@ function tracker {
 }
 
 function usage {
-    echo "Usage: $0 [-x] [-s N]" 1>&2
+    echo "Usage: $0 [-x] [-j] [-s N]" 1>&2
     exit 1
 }
 
-while getopts ":s:x" opt; do
+while getopts ":s:xj" opt; do
     case $opt in
+        j)
+            MLOCK_REPORT_FORMAT=json
+            ;;
         s)
             SLEEP_TIME=$OPTARG
             ;;
@@ -1,52 +1,102 @@
 # This tool lists processes that lock memory pages from swapping to disk.
 
-import re
+import argparse
+import json
+import os
 
-import psutil
 
+PROC_PATH = '/proc'
+# Name: and VmLck: come well within the first page of a status file
+STATUS_READ_SIZE = 4096
 
-LCK_SUMMARY_REGEX = re.compile(
-    r"^VmLck:\s+(?P<locked>[\d]+)\s+kB", re.MULTILINE)
+
+def get_options():
+    parser = argparse.ArgumentParser(
+        description='List processes locking memory')
+    parser.add_argument('-f', '--format',
+                        default='text', choices=('text', 'json'),
+                        help='Write a single log line, or a JSON document')
+    return parser.parse_args()
 
 
 def main():
+    opts = get_options()
     try:
-        print(_get_report())
+        print(_get_report(opts.format))
     except Exception as e:
         print("Failure listing processes locking memory: %s" % str(e))
         raise
 
 
-def _get_report():
+def _read_status(pid):
+    """Return the name and locked kB of a process from its status file."""
+    fd = os.open("%s/%s/status" % (PROC_PATH, pid), os.O_RDONLY)
+    try:
+        status = os.read(fd, STATUS_READ_SIZE)
+    finally:
+        os.close(fd)
+    name = None
+    for line in status.split(b'\n'):
+        if line.startswith(b'Name:'):
+            name = line[5:].strip().decode('utf-8', 'replace')
+        elif line.startswith(b'VmLck:'):
+            # e.g. b'VmLck:\t       0 kB'
+            return name, int(line[6:].split()[0])
+    # kernel threads have no VmLck
+    return name, 0
+
+
+def _get_meminfo(fields=('Unevictable', 'Mlocked')):
+    meminfo = {}
+    with open("%s/meminfo" % PROC_PATH, 'rb') as f:
+        for line in f:
+            key, _, value = line.partition(b':')
+            key = key.decode()
+            if key in fields:
+                meminfo[key] = int(value.split()[0])
+    return meminfo
+
+
+def _get_mlock_users():
     mlock_users = []
-    for proc in psutil.process_iter():
-        # sadly psutil does not expose locked pages info, that's why we
-        # iterate over the /proc/%pid/status files manually
+    for pid in os.listdir(PROC_PATH):
+        if not pid.isdigit():
+            continue
         try:
-            s = open("%s/%d/status" % (psutil.PROCFS_PATH, proc.pid), 'r')
-            with s:
-                for line in s:
-                    result = LCK_SUMMARY_REGEX.search(line)
-                    if result:
-                        locked = int(result.group('locked'))
-                        if locked:
-                            mlock_users.append({'name': proc.name(),
-                                                'pid': proc.pid,
-                                                'locked': locked})
+            name, locked = _read_status(pid)
         except OSError:
             # pids can disappear, we're ok with that
             continue
+        if locked:
+            mlock_users.append({'name': name,
+                                'pid': int(pid),
+                                'locked': locked})
+    # log heavy users first
+    mlock_users.sort(key=lambda d: d['locked'], reverse=True)
+    return mlock_users
+
+
+def _get_report(fmt='text'):
+    mlock_users = _get_mlock_users()
+    meminfo = _get_meminfo()
 
+    if fmt == 'json':
+        return json.dumps({
+            'unevictable': meminfo.get('Unevictable'),
+            'mlocked': meminfo.get('Mlocked'),
+            'processes': mlock_users,
+        })
 
     # produce a single line log message with per process mlock stats
     if mlock_users:
-        return "; ".join(
+        report = "; ".join(
             "[%(name)s (pid:%(pid)s)]=%(locked)dKB" % args
-            # log heavy users first
-            for args in sorted(mlock_users, key=lambda d: d['locked'])
+            for args in mlock_users
         )
     else:
-        return "no locked memory"
+        report = "no locked memory"
+    return report + " (%s)" % ", ".join(
+        "%s: %dKB" % item for item in sorted(meminfo.items()))
 
 
 if __name__ == "__main__":
@@ -22,12 +22,30 @@
 # times during a run.
 
 import argparse
-import datetime
+import json
+import os
 import re
+import select
+import signal
 import sys
+import time
+import zlib
 
-IGNORE_LINES = re.compile(r'(set \+o|xtrace)')
-HAS_DATE = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}.\d{3} \|')
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Lines are checked for these substrings, which is much cheaper than a
+# regex search for either
+IGNORE_LINES = (b'set +o', b'xtrace')
+HAS_DATE = re.compile(rb'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}.\d{3} \|')
+# Where the " |" after a date would be, checked before HAS_DATE
+DATE_END = slice(23, 25)
+
+READ_SIZE = 65536
+# In buffered mode, flush when input goes quiet for this long
+IDLE_TIMEOUT = 0.1
 
 
 def get_options():
@@ -45,56 +63,292 @@ def get_options():
                         default=False)
     parser.add_argument('-v', '--verbose', action='store_true',
                         default=False)
-    return parser.parse_args()
+    parser.add_argument('-B', '--buffered', action='store_true',
+                        help=('Batch output, flushing when input goes idle, '
+                              'or after --flush-interval or --flush-size'),
+                        default=False)
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                        help=('Longest time output is buffered for, in '
+                              'seconds (default: 1)'))
+    parser.add_argument('--flush-size', type=int, default=1 << 20,
+                        help=('Most output buffered, in bytes '
+                              '(default: 1MiB)'))
+    parser.add_argument('-z', '--compress', choices=('gzip', 'zstd'),
+                        help=('Compress the output file, adding the suffix '
+                              'to its name if needed'),
+                        default=None)
+    parser.add_argument('--rotate-size', type=int, default=0,
+                        help=('Continue in a new output file, with .1, .2 '
+                              'etc. before the suffix, once it has this '
+                              'many bytes'))
+    parser.add_argument('--index', action='store_true',
+                        help=('Record where the output of each minute '
+                              'starts in OUTFILE.index'),
+                        default=False)
+    opts = parser.parse_args()
+    if opts.compress == 'zstd' and zstandard is None:
+        parser.error('zstd compression needs the zstandard module')
+    return opts
 
 
 def skip_line(line):
     """Should we skip this line."""
-    return IGNORE_LINES.search(line) is not None
+    return IGNORE_LINES[0] in line or IGNORE_LINES[1] in line
+
+
+def has_date(line):
+    return line[DATE_END] == b' |' and HAS_DATE.match(line) is not None
+
+
+class Output(object):
+    """Collects lines for a file object and writes them out in one go."""
+    def __init__(self, f):
+        self.f = f
+        self.lines = []
+        self.size = 0
+
+    def write(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+
+    def flush(self):
+        if self.lines:
+            self.f.write(b''.join(self.lines))
+            self.f.flush()
+            self.lines = []
+            self.size = 0
+
+
+class GzipCompressor(object):
+    suffix = '.gz'
+
+    def __init__(self):
+        # A gzip member, rather than a raw deflate stream
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def sync(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class ZstdCompressor(object):
+    suffix = '.zst'
+
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor().compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def sync(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+COMPRESSORS = {
+    'gzip': GzipCompressor,
+    'zstd': ZstdCompressor,
+}
+
+
+class LogFile(Output):
+    """An output file, optionally compressed, rotated and indexed.
+
+    Compressed output is written as a series of independent gzip members
+    or zstd frames, which concatenated are still a valid file, so a
+    reader can start decompressing at the start of any of them. A new
+    one is started every minute and on rotation, and the index records
+    the file and offset they start at. Every flush is a sync point, so
+    what was written so far can be decompressed while we still write.
+    """
+    def __init__(self, path, compress=None, rotate_size=0, index=False):
+        self.compressor_class = COMPRESSORS.get(compress)
+        self.suffix = ''
+        if self.compressor_class:
+            self.suffix = self.compressor_class.suffix
+            if path.endswith(self.suffix):
+                path = path[:-len(self.suffix)]
+        self.path = path
+        self.rotate_size = rotate_size
+        self.number = 0
+        self.minute = None
+        self.index = open(path + self.suffix + '.index', 'a',
+                          buffering=1) if index else None
+        super().__init__(None)
+        self.open()
+
+    def open(self):
+        name = self.path
+        if self.number:
+            name += '.%d' % self.number
+        self.name = name + self.suffix
+        # note, binary mode and unbuffered, as we batch writes ourselves
+        self.f = open(self.name, 'ab', 0)
+        self.offset = self.f.tell()
+        self.compressor = None
+
+    def write_through(self, data):
+        if self.compressor_class:
+            if self.compressor is None:
+                self.compressor = self.compressor_class()
+            data = self.compressor.compress(data)
+        self.f.write(data)
+        self.offset += len(data)
+
+    def finish(self):
+        """End the current gzip member or zstd frame, if any."""
+        if self.compressor is not None:
+            data = self.compressor.finish()
+            self.f.write(data)
+            self.offset += len(data)
+            self.compressor = None
+
+    def record(self):
+        if self.index:
+            self.index.write(json.dumps({
+                'time': time.strftime('%Y-%m-%d %H:%M',
+                                      time.gmtime(self.minute * 60)),
+                'file': os.path.basename(self.name),
+                'offset': self.offset,
+            }) + '\n')
+
+    def mark(self, now):
+        """Start a new section of the output if a new minute began."""
+        minute = int(now // 60)
+        if minute != self.minute:
+            self.flush()
+            self.finish()
+            self.minute = minute
+            self.record()
+
+    def flush(self):
+        if self.lines:
+            self.write_through(b''.join(self.lines))
+            self.lines = []
+            self.size = 0
+            if self.compressor is not None:
+                data = self.compressor.sync()
+                self.f.write(data)
+                self.offset += len(data)
+        if self.rotate_size and self.offset >= self.rotate_size:
+            self.finish()
+            self.f.close()
+            self.number += 1
+            self.open()
+            self.record()
+
+    def close(self):
+        self.flush()
+        self.finish()
+        self.f.close()
+
+
+class Timestamper(object):
+    """Formats timestamps, once per millisecond."""
+    def __init__(self):
+        self.ms = None
+        self.prefix = None
+
+    def __call__(self, now):
+        ms = int(now * 1000)
+        if ms != self.ms:
+            self.ms = ms
+            self.prefix = ('%s.%03d | ' % (
+                time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ms // 1000)),
+                ms % 1000)).encode()
+        return self.prefix
 
 
 def main():
     opts = get_options()
-    outfile = None
+    outputs = []
+    outfile = stdout = None
     if opts.outfile:
-        # note, binary mode so we can do unbuffered output.
-        outfile = open(opts.outfile, 'ab', 0)
-
-    # Otherwise fileinput reprocess args as files
-    sys.argv = []
-
-    for line in iter(sys.stdin.readline, ''):
-        # put skip lines here
-        if skip_line(line):
-            continue
-
-        # This prevents us from nesting date lines, because we'd like
-        # to pull this in directly in Grenade and not double up on
-        # DevStack lines.
-        # NOTE(ianw): we could actually strip the extra ts in "bare"
-        # mode (which came after this)? ... as we get more experience
-        # with zuulv3 native jobs and ansible capture it may become
-        # clearer what to do
-        if HAS_DATE.search(line) is None:
-            now = datetime.datetime.now(datetime.timezone.utc).replace(
-                    tzinfo=None)
-            ts_line = ("%s | %s" % (
-                now.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
-                line))
-        else:
-            ts_line = line
-
-        if opts.verbose:
-            sys.stdout.write(line if opts.no_timestamp else ts_line)
-            sys.stdout.flush()
+        outfile = LogFile(opts.outfile, opts.compress, opts.rotate_size,
+                          opts.index)
+        outputs.append(outfile)
+    if opts.verbose:
+        stdout = Output(sys.stdout.buffer)
+        outputs.append(stdout)
+
+    def flush():
+        for output in outputs:
+            output.flush()
+
+    # Don't lose buffered output when we are killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    timestamp = Timestamper()
+    fd = sys.stdin.fileno()
+    partial = b''
+    buffered_since = None
+    try:
+        while True:
+            if buffered_since is not None:
+                ready, _, _ = select.select([fd], [], [], IDLE_TIMEOUT)
+                if not ready:
+                    flush()
+                    buffered_since = None
+                    continue
+            data = os.read(fd, READ_SIZE)
+            now = time.time()
+            if not data:
+                lines = [partial] if partial else []
+            else:
+                lines = (partial + data).split(b'\n')
+                partial = lines.pop()
+
+            # Everything read at once is stamped with the time it was
+            # read at, as reading line by line would have done.
+            prefix = timestamp(now)
+            if outfile:
+                outfile.mark(now)
+            for line in lines:
+                if data:
+                    line += b'\n'
+                # put skip lines here
+                if skip_line(line):
+                    continue
+
+                # This prevents us from nesting date lines, because we'd
+                # like to pull this in directly in Grenade and not double
+                # up on DevStack lines.
+                # NOTE(ianw): we could actually strip the extra ts in
+                # "bare" mode (which came after this)? ... as we get more
+                # experience with zuulv3 native jobs and ansible capture
+                # it may become clearer what to do
+                if has_date(line):
+                    ts_line = line
+                else:
+                    ts_line = prefix + line
+
+                if stdout:
+                    stdout.write(line if opts.no_timestamp else ts_line)
+
+                if outfile:
+                    outfile.write(ts_line)
 
+            if not data:
+                break
+            if buffered_since is None:
+                buffered_since = now
+            if (not opts.buffered or
+                    now - buffered_since >= opts.flush_interval or
+                    any(output.size >= opts.flush_size
+                        for output in outputs)):
+                flush()
+                buffered_since = None
+    finally:
+        flush()
         if outfile:
-            # We've opened outfile as a binary file to get the
-            # non-buffered behaviour. on python3, sys.stdin was
-            # opened with the system encoding and made the line into
-            # utf-8, so write the logfile out in utf-8 bytes.
-            outfile.write(ts_line.encode('utf-8'))
-            outfile.flush()
+            outfile.close()
 
 
 if __name__ == '__main__':
@@ -18,13 +18,21 @@
 """Dump the state of the world for post mortem."""
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
-import fnmatch
+import glob
 import io
+import json
 import os
+import re
+import shlex
 import shutil
+import signal
+import socket
 import subprocess
 import sys
+import time
 
 
 GMR_PROCESSES = (
@@ -46,45 +54,272 @@ def get_options():
     parser.add_argument('-n', '--name',
                         default='',
                         help='Additional name to tag into file')
+    parser.add_argument('-j', '--jobs',
+                        default=8, type=int,
+                        help='Number of commands to run at the same time')
+    parser.add_argument('-t', '--timeout',
+                        default=60, type=int,
+                        help='Seconds after which a command is killed')
+    parser.add_argument('-f', '--format',
+                        default='text', choices=('text', 'json'),
+                        help=('Write free text, or a JSON record of every '
+                              'command run by each collector'))
+    parser.add_argument('--instances-dir',
+                        default='/opt/stack/data/nova/instances',
+                        help=('Where nova keeps the console.log of '
+                              'instances; all of /opt/stack is searched '
+                              'if it does not exist'))
+    parser.add_argument('--console-bytes',
+                        default=1024 * 1024, type=int,
+                        help=('Most bytes of each console.log to dump, '
+                              'from its end'))
     return parser.parse_args()
 
 
-def filename(dirname, name=""):
+def filename(dirname, name="", ext="txt"):
     now = datetime.datetime.now(datetime.timezone.utc)
     fmt = "worlddump-%Y-%m-%d-%H%M%S"
     if name:
         fmt += "-" + name
-    fmt += ".txt"
+    fmt += "." + ext
     return os.path.join(dirname, now.strftime(fmt))
 
 
-def warn(msg):
-    print("WARN: %s" % msg)
+# Where compute_consoles remembers how far it dumped each console.log,
+# in the output directory
+CONSOLE_STATE = '.worlddump-consoles.json'
 
+CommandResult = collections.namedtuple(
+    'CommandResult', ['cmd', 'rc', 'duration', 'output', 'error'])
 
-def _dump_cmd(cmd):
-    print(cmd)
-    print("-" * len(cmd))
-    print()
-    try:
-        subprocess.check_call(cmd, shell=True)
-        print()
-    except subprocess.CalledProcessError as e:
-        print("*** Failed to run '%(cmd)s': %(err)s" % {'cmd': cmd, 'err': e})
-
+PS_REGEX = re.compile(
+    r'^(?P<user>\S+)\s+(?P<ppid>\d+)\s+(?P<pid>\d+)\s+'
+    r'(?P<pcpu>[\d.]+)\s+(?P<pmem>[\d.]+)\s+(?P<vsz>\d+)\s+(?P<rss>\d+)\s+'
+    r'(?P<tty>\S+)\s+(?P<stat>\S+)\s+'
+    # HH:MM:SS today, "Mmm dd" before that
+    r'(?P<start>\d\d:\d\d:\d\d|\w{3} ?\d{1,2}|\d{4})\s+'
+    r'(?P<time>[\d:-]+)\s+(?P<args>.*)$')
 
-def _find_cmd(cmd):
-    if not shutil.which(cmd):
-        print("*** %s not found: skipping" % cmd)
-        return False
-    return True
 
-
-def _header(name):
-    print()
-    print(name)
-    print("=" * len(name))
-    print()
+def _kill_session(pid):
+    """Kill all of the session led by pid, which we have not reaped yet."""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (PermissionError, ProcessLookupError):
+        pass
+    # Children run with sudo are not ours to kill, so leave whatever is
+    # left of the group to sudo
+    try:
+        subprocess.run(['sudo', '-n', 'kill', '-KILL', '--', '-%i' % pid],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        # No sudo here, so nothing ran with it either
+        pass
+
+
+def _run_cmd(cmd, timeout):
+    """Run a shell command and return its CommandResult.
+
+    The command runs in a session of its own, so that all of it can be
+    killed if it takes longer than timeout seconds.
+    """
+    start = time.monotonic()
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                               start_new_session=True)
+    error = None
+    try:
+        stdout, _ = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_session(process.pid)
+        try:
+            stdout, _ = process.communicate(timeout=5)
+        except subprocess.TimeoutExpired as e:
+            # Something left holds on to its stdout, give up on it but
+            # keep what it wrote so far
+            stdout = e.output or b''
+            try:
+                process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                pass
+        error = 'timed out after %i seconds' % timeout
+    if process.returncode and error is None:
+        error = subprocess.CalledProcessError(process.returncode, cmd)
+    return CommandResult(cmd, process.returncode, time.monotonic() - start,
+                         stdout.decode('utf-8', 'replace'), error)
+
+
+def _run_batch(prefix, cmds, timeout):
+    """Run several commands under prefix with a single helper shell.
+
+    This costs one prefix (e.g. sudo + entering a namespace) rather than
+    one per command. Every command is followed by a marker line with its
+    exit code and the time, so the output can be split back into one
+    CommandResult per command.
+    """
+    marker = 'worlddump-batch-%i' % os.getpid()
+    script = "printf '\\n%s 0 %%s\\n' \"$EPOCHREALTIME\"" % marker
+    for cmd in cmds:
+        script += "; %s; printf '\\n%s %%i %%s\\n' $? \"$EPOCHREALTIME\"" % (
+            cmd, marker)
+    batch = _run_cmd('%s bash -c %s' % (prefix, shlex.quote(script)),
+                     timeout)
+    # ['', '0', start, output, rc, end, output, rc, end, ..., rest]
+    parts = re.split(r'\n%s (\d+) (\S*)\n' % marker, '\n' + batch.output)
+    results = []
+    for i, cmd in enumerate(cmds):
+        cmd = '%s %s' % (prefix, cmd)
+        done = parts[3 * i + 3:3 * i + 6]
+        if len(done) < 3:
+            # The helper failed or was killed before this one finished
+            output = done[0] if done else ''
+            error = batch.error
+            if not isinstance(error, str):
+                error = subprocess.CalledProcessError(batch.rc, cmd)
+            results.append(CommandResult(cmd, batch.rc, 0.0, output, error))
+            continue
+        output, rc, end = done
+        start = parts[3 * i + 2]
+        duration = float(end) - float(start) if start and end else 0.0
+        error = subprocess.CalledProcessError(int(rc), cmd) if int(rc) else None
+        results.append(CommandResult(cmd, int(rc), duration, output, error))
+    return results
+
+
+def parse_df(output):
+    """Parse the output of df -P into a record per file system."""
+    filesystems = []
+    for line in output.splitlines()[1:]:
+        fields = line.split(None, 5)
+        if len(fields) != 6:
+            continue
+        filesystem, size, used, available, capacity, mounted = fields
+        try:
+            capacity = int(capacity.rstrip('%'))
+        except ValueError:
+            capacity = None
+        filesystems.append({'filesystem': filesystem, 'size': size,
+                            'used': used, 'available': available,
+                            'capacity': capacity, 'mounted': mounted})
+    return filesystems
+
+
+def parse_ps(output):
+    """Parse the output of our ps axo into a record per process."""
+    processes = []
+    for line in output.splitlines()[1:]:
+        match = PS_REGEX.match(line)
+        if match is None:
+            continue
+        process = match.groupdict()
+        for field in ('ppid', 'pid', 'vsz', 'rss'):
+            process[field] = int(process[field])
+        for field in ('pcpu', 'pmem'):
+            process[field] = float(process[field])
+        processes.append(process)
+    return processes
+
+
+class Section(object):
+    """The output of one collector.
+
+    Collectors add text and commands to their section. The commands run
+    in a shared thread pool, and the section is rendered in the order
+    things were added to it once they have all finished.
+    """
+    def __init__(self, pool, opts):
+        self.pool = pool
+        self.opts = opts
+        self.timeout = opts.timeout
+        # Text, or (future CommandResult, parser, whether to show it)
+        self.parts = []
+        self.headers = []
+        self.messages = []
+
+    def print(self, text='', record=True):
+        self.parts.append(text + '\n')
+        if record and text.strip():
+            self.messages.append(text.strip())
+
+    def warn(self, msg):
+        self.print("WARN: %s" % msg)
+
+    def header(self, name):
+        self.headers.append(name)
+        self.parts.append('\n%s\n%s\n\n' % (name, "=" * len(name)))
+
+    def dump_cmd(self, cmd, parser=None):
+        future = self.pool.submit(_run_cmd, cmd, self.timeout)
+        self.parts.append((future, parser, True))
+        return future
+
+    def dump_batch(self, prefix, cmds):
+        """Dump several commands run under prefix by one helper shell."""
+        self.parts.append((self.pool.submit(_run_batch, prefix, cmds,
+                                            self.timeout), None, True))
+
+    def run_cmd(self, cmd, parser=None):
+        """Run a command right away and return its CommandResult.
+
+        The collector shows what it wants of the result itself; the
+        command is only recorded as such in the JSON format.
+        """
+        future = concurrent.futures.Future()
+        future.set_result(_run_cmd(cmd, self.timeout))
+        self.parts.append((future, parser, False))
+        return future.result()
+
+    def find_cmd(self, cmd):
+        if not shutil.which(cmd):
+            self.print("*** %s not found: skipping" % cmd)
+            return False
+        return True
+
+    @staticmethod
+    def _results(future):
+        results = future.result()
+        return [results] if isinstance(results, CommandResult) else results
+
+    def render(self):
+        text = []
+        for part in self.parts:
+            if isinstance(part, str):
+                text.append(part)
+                continue
+            future, _, show = part
+            if not show:
+                continue
+            for result in self._results(future):
+                text.append("%s\n%s\n\n" % (result.cmd,
+                                              "-" * len(result.cmd)))
+                text.append(result.output)
+                if result.error is None:
+                    text.append("\n")
+                else:
+                    text.append("*** Failed to run '%(cmd)s': %(err)s\n" % {
+                        'cmd': result.cmd, 'err': result.error})
+        return ''.join(text)
+
+    def record(self):
+        """Return the section as a record for the JSON format."""
+        commands = []
+        for part in self.parts:
+            if isinstance(part, str):
+                continue
+            future, parser, _ = part
+            for result in self._results(future):
+                command = {
+                    'command': result.cmd,
+                    'rc': result.rc,
+                    'duration': round(result.duration, 3),
+                    'output': result.output,
+                    'error': result.error and str(result.error),
+                }
+                if parser and result.rc == 0:
+                    command['parsed'] = parser(result.output)
+                commands.append(command)
+        return {'headers': self.headers,
+                'messages': self.messages,
+                'commands': commands}
 
 
 def _bridge_list():
@@ -113,39 +348,35 @@ def _get_ofp_version():
     return int(stdout[offset + len(find_str):-1]) - 1
 
 
-def disk_space():
+def disk_space(out):
     # the df output
-    _header("File System Summary")
+    out.header("File System Summary")
 
-    dfraw = os.popen("df -Ph").read()
-    df = [s.split() for s in dfraw.splitlines()]
-    for fs in df:
-        try:
-            if int(fs[4][:-1]) > 95:
-                warn("Device %s (%s) is %s full, might be an issue" % (
-                    fs[0], fs[5], fs[4]))
-        except ValueError:
-            # if it doesn't look like an int, that's fine
-            pass
+    df = out.run_cmd("df -Ph", parse_df)
+    for fs in parse_df(df.output):
+        # if it doesn't look like an int, that's fine
+        if fs['capacity'] is not None and fs['capacity'] > 95:
+            out.warn("Device %s (%s) is %s%% full, might be an issue" % (
+                fs['filesystem'], fs['mounted'], fs['capacity']))
 
-    print(dfraw)
+    out.print(df.output, record=False)
 
 
-def ebtables_dump():
+def ebtables_dump(out):
     tables = ['filter', 'nat']
-    _header("EB Tables Dump")
-    if not _find_cmd('ebtables'):
+    out.header("EB Tables Dump")
+    if not out.find_cmd('ebtables'):
         return
     for table in tables:
-        _dump_cmd("sudo ebtables -t %s -L" % table)
+        out.dump_cmd("sudo ebtables -t %s -L" % table)
 
 
-def iptables_dump():
+def iptables_dump(out):
     tables = ['filter', 'nat', 'mangle']
-    _header("IP Tables Dump")
+    out.header("IP Tables Dump")
 
     for table in tables:
-        _dump_cmd("sudo iptables --line-numbers -L -nv -t %s" % table)
+        out.dump_cmd("sudo iptables --line-numbers -L -nv -t %s" % table)
 
 
 def _netns_list():
@@ -158,26 +389,26 @@ def _netns_list():
     return output
 
 
-def network_dump():
-    _header("Network Dump")
+def network_dump(out):
+    out.header("Network Dump")
 
-    _dump_cmd("bridge link")
-    _dump_cmd("ip link show type bridge")
+    out.dump_cmd("bridge link")
+    out.dump_cmd("ip link show type bridge")
     ip_cmds = ["neigh", "addr", "route", "-6 route"]
     for cmd in ip_cmds + ['netns']:
-        _dump_cmd("ip %s" % cmd)
+        out.dump_cmd("ip %s" % cmd)
+    # Enter each namespace once, rather than once per command
     for netns_ in _netns_list():
-        for cmd in ip_cmds:
-            args = {'netns': bytes.decode(netns_), 'cmd': cmd}
-            _dump_cmd('sudo ip netns exec %(netns)s ip %(cmd)s' % args)
+        out.dump_batch('sudo ip netns exec %s' % bytes.decode(netns_),
+                       ['ip %s' % cmd for cmd in ip_cmds])
 
 
-def ovs_dump():
-    _header("Open vSwitch Dump")
+def ovs_dump(out):
+    out.header("Open vSwitch Dump")
 
     # NOTE(cdent): If we're not using neutron + ovs these commands
     # will not be present so
-    if not _find_cmd('ovs-vsctl'):
+    if not out.find_cmd('ovs-vsctl'):
         return
 
     bridges = _bridge_list()
@@ -186,80 +417,174 @@ def ovs_dump():
     vers = 'OpenFlow10'
     for i in range(1, ofp_max + 1):
         vers += ',OpenFlow1' + str(i)
-    _dump_cmd("sudo ovs-vsctl show")
+    out.dump_cmd("sudo ovs-vsctl show")
     for ofctl_cmd in ofctl_cmds:
         for bridge in bridges:
             args = {'vers': vers, 'cmd': ofctl_cmd, 'bridge': bytes.decode(bridge)}
-            _dump_cmd("sudo ovs-ofctl --protocols=%(vers)s %(cmd)s %(bridge)s" % args)
+            out.dump_cmd("sudo ovs-ofctl --protocols=%(vers)s %(cmd)s %(bridge)s" % args)
+
 
+def process_list(out):
+    out.header("Process Listing")
+    out.dump_cmd("ps axo "
+                 "user,ppid,pid,pcpu,pmem,vsz,rss,tty,stat,start,time,args",
+                 parse_ps)
 
-def process_list():
-    _header("Process Listing")
-    _dump_cmd("ps axo "
-              "user,ppid,pid,pcpu,pmem,vsz,rss,tty,stat,start,time,args")
 
+def _console_offsets(state):
+    try:
+        with io.open(state) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _console_logs(instances_dir):
+    """Return the paths of the console.log files of instances."""
+    if os.path.isdir(instances_dir):
+        return sorted(glob.glob(
+            os.path.join(instances_dir, '*', 'console.log')))
+    # Not where we expected, look for them anywhere like we used to
+    return sorted(os.path.join(root, 'console.log')
+                  for root, _, filenames in os.walk('/opt/stack')
+                  if 'console.log' in filenames)
+
+
+def compute_consoles(out):
+    out.header("Compute consoles")
+    opts = out.opts
+    state = os.path.join(opts.dir, CONSOLE_STATE)
+    # Only dump what was added since the last worlddump, so that
+    # repeated dumps in a job do not repeat the whole console each time
+    offsets = _console_offsets(state)
+    dumped = {}
+    pending = []
+    for fullpath in _console_logs(opts.instances_dir):
+        try:
+            st = os.stat(fullpath)
+        except FileNotFoundError:
+            # The instance was deleted in the meantime
+            continue
+        except OSError:
+            out.dump_cmd("sudo cat %s" % fullpath)
+            continue
+        inode, offset = offsets.get(fullpath, (None, 0))
+        if inode != st.st_ino or offset > st.st_size:
+            # A new instance, or a console.log that was started over
+            offset = 0
+        start = max(offset, st.st_size - opts.console_bytes)
+        if start > offset:
+            out.print("Skipping %d bytes of %s" % (start - offset, fullpath))
+        if start == st.st_size:
+            out.print("Nothing new in %s" % fullpath)
+            dumped[fullpath] = (st.st_ino, st.st_size)
+            continue
+        if offset:
+            # Keep the old offset in case this dump fails
+            dumped[fullpath] = (st.st_ino, offset)
+        # A single command, so that its status is the one of the read
+        future = out.dump_cmd(
+            "sudo dd if=%s iflag=skip_bytes,count_bytes skip=%d count=%d "
+            "bs=64K status=none" % (fullpath, start, st.st_size - start))
+        pending.append((fullpath, (st.st_ino, st.st_size), future))
+
+    # Only move past what actually made it into the dump
+    for fullpath, seen, future in pending:
+        result = future.result()
+        if result.rc == 0 and result.error is None:
+            dumped[fullpath] = seen
 
-def compute_consoles():
-    _header("Compute consoles")
-    for root, _, filenames in os.walk('/opt/stack'):
-        for filename in fnmatch.filter(filenames, 'console.log'):
-            fullpath = os.path.join(root, filename)
-            _dump_cmd("sudo cat %s" % fullpath)
+    try:
+        with io.open(state + '.tmp', 'w') as f:
+            json.dump(dumped, f)
+        os.replace(state + '.tmp', state)
+    except OSError as e:
+        out.warn("Could not save console offsets: %s" % e)
 
 
-def guru_meditation_reports():
+def guru_meditation_reports(out):
     for service in GMR_PROCESSES:
-        _header("%s Guru Meditation Report" % service)
+        out.header("%s Guru Meditation Report" % service)
 
-        try:
-            subprocess.check_call(['pgrep', '-f', service])
-        except subprocess.CalledProcessError:
-            print("Skipping as %s does not appear to be running" % service)
+        pgrep = subprocess.run(['pgrep', '-f', service],
+                               stdout=subprocess.PIPE)
+        if pgrep.stdout:
+            out.print(pgrep.stdout.decode().rstrip('\n'))
+        if pgrep.returncode:
+            out.print("Skipping as %s does not appear to be running" %
+                      service)
             continue
 
-        _dump_cmd("killall -e -USR2 %s" % service)
-        print("guru meditation report in %s log" % service)
+        out.dump_cmd("killall -e -USR2 %s" % service)
+        out.print("guru meditation report in %s log" % service)
 
 
-def var_core():
+def var_core(out):
     if os.path.exists('/var/core'):
-        _header("/var/core dumps")
+        out.header("/var/core dumps")
         # NOTE(ianw) : see DEBUG_LIBVIRT_COREDUMPS.  We could think
         # about getting backtraces out of these.  There are other
         # tools out there that can do that sort of thing though.
-        _dump_cmd("ls -ltrah /var/core")
+        out.dump_cmd("ls -ltrah /var/core")
+
+
+# In the order their output goes in the file
+COLLECTORS = (
+    disk_space,
+    process_list,
+    network_dump,
+    ovs_dump,
+    iptables_dump,
+    ebtables_dump,
+    compute_consoles,
+    guru_meditation_reports,
+    var_core,
+)
 
 
-def disable_stdio_buffering():
-    # re-open STDOUT as binary, then wrap it in a
-    # TextIOWrapper, and write through everything.
-    binary_stdout = io.open(sys.stdout.fileno(), 'wb', 0)
-    sys.stdout = io.TextIOWrapper(binary_stdout, write_through=True)
+def collect(out, collector):
+    try:
+        collector(out)
+    except Exception as e:
+        out.print("*** Failed to collect %s: %s" % (collector.__name__, e))
 
 
 def main():
     opts = get_options()
-    fname = filename(opts.dir, opts.name)
+    ext = 'json' if opts.format == 'json' else 'txt'
+    fname = filename(opts.dir, opts.name, ext)
     print("World dumping... see %s for details" % fname)
 
-    disable_stdio_buffering()
-
-    with io.open(fname, 'w') as f:
-        os.dup2(f.fileno(), sys.stdout.fileno())
-        disk_space()
-        process_list()
-        network_dump()
-        ovs_dump()
-        iptables_dump()
-        ebtables_dump()
-        compute_consoles()
-        guru_meditation_reports()
-        var_core()
+    # The collectors run concurrently, and so do the commands they run,
+    # each into the section of its collector. The sections are written
+    # out in order, so the file reads the same as if they ran one after
+    # the other.
+    with concurrent.futures.ThreadPoolExecutor(opts.jobs) as commands, \
+            concurrent.futures.ThreadPoolExecutor(len(COLLECTORS)) as pool:
+        sections = [Section(commands, opts) for _ in COLLECTORS]
+        for future in [pool.submit(collect, section, collector)
+                       for section, collector in zip(sections, COLLECTORS)]:
+            future.result()
+
+        with io.open(fname, 'w') as f:
+            if opts.format == 'json':
+                json.dump({
+                    'timestamp': datetime.datetime.now(
+                        datetime.timezone.utc).isoformat(),
+                    'hostname': socket.gethostname(),
+                    'collectors': [
+                        dict(collector=collector.__name__,
+                             **section.record())
+                        for section, collector in zip(sections, COLLECTORS)],
+                }, f, indent=1)
+            else:
+                for section in sections:
+                    f.write(section.render())
     # Singular name for ease of log retrieval
     copyname = os.path.join(opts.dir, 'worlddump')
     if opts.name:
         copyname += '-' + opts.name
-    copyname += '-latest.txt'
+    copyname += '-latest.' + ext
     # We make a full copy to deal with jobs that may or may not
     # gzip logs breaking symlinks.
     shutil.copyfile(fname, copyname)